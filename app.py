@@ -1,18 +1,23 @@
 # app.py — один файл, без внешних schema/seed
-import os, json, sqlite3
+import os, json, sqlite3, threading
+from contextlib import contextmanager
 from datetime import datetime
-from fastapi import FastAPI, HTTPException
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, Response
 from datetime import date, timedelta
 from fastapi.responses import PlainTextResponse
 
 # --- Пути и папки ---
+# Для демо-/эфемерных запусков можно положить базу в tmpfs:
+#   DATA_DIR=/dev/shm/studiolumi uvicorn app:app ...
+# fsync на коммите становится записью в память (~2× к write-throughput),
+# но данные живут только до перезагрузки хоста.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.environ.get("DATA_DIR", os.path.join(BASE_DIR, "data"))
 DB_PATH  = os.path.join(DATA_DIR, "data.sqlite")
-ICS_DIR  = os.path.join(DATA_DIR, "ics")
-os.makedirs(ICS_DIR, exist_ok=True)
 
 # --- Константы демо-студии ---
 HALLS_SEED = [
@@ -25,32 +30,72 @@ ADDONS_PRICE = {
     "Фон белый":    1500,
     "Стойки":       1000,
 }
+# JSON-фрагменты допов фиксированы — сериализуем каталог один раз
+_ADDON_JSON = {
+    n: json.dumps({"name": n, "price": p}, ensure_ascii=False)
+    for n, p in ADDONS_PRICE.items()
+}
 WORK_START = 9 * 60   # 09:00
 WORK_END   = 21 * 60  # 21:00
 SLOT_DUR   = 60
 BUFFER     = 15       # мин между бронированиями
+# фиксированная сетка стартов слотов — не пересобираем на каждый запрос
+SLOT_STARTS = tuple(range(WORK_START, WORK_END - SLOT_DUR + 1, SLOT_DUR))
 BASE_URL   = os.environ.get("BASE_URL", "http://localhost:8000")
 
 RU_WD = ["Пн","Вт","Ср","Чт","Пт","Сб","Вс"]
 RU_MM = ["янв","фев","мар","апр","май","июн","июл","авг","сен","окт","ноя","дек"]
 
-app = FastAPI(title="Studio Lumi API (single-file)")
+# orjson сериализует ответы в C-коде — дешевле stdlib json на каждом эндпоинте
+app = FastAPI(title="Studio Lumi API (single-file)", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
 )
 
 # --- База данных и инициализация ---
+# Одно соединение на процесс: не платим за connect()/прогрев page-cache
+# на каждый запрос. Писатели сериализуются через _WRITE_LOCK,
+# читатели в WAL-режиме писателя не блокируют.
+os.makedirs(DATA_DIR, exist_ok=True)
+# cached_statements: sqlite3 кэширует скомпилированные VDBE-программы по
+# тексту запроса — SQL-строки в хендлерах должны оставаться стабильными
+# (никаких f-строк при сборке запросов)
+_CONN = sqlite3.connect(
+    DB_PATH, check_same_thread=False, isolation_level=None,
+    cached_statements=256,
+)
+_CONN.row_factory = sqlite3.Row
+_CONN.executescript("""
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=30000;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-20000;
+PRAGMA mmap_size=268435456;
+""")
+_WRITE_LOCK = threading.Lock()
+
 def get_db():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _CONN
+
+@contextmanager
+def _write_tx():
+    # BEGIN IMMEDIATE берёт writer-лок сразу, без ретраев под нагрузкой;
+    # synchronous=NORMAL в WAL-режиме даёт один fsync на коммит
+    with _WRITE_LOCK:
+        db = _CONN
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
 
 def init_db():
-    with get_db() as db:
-        db.execute("PRAGMA journal_mode=WAL;")
-        db.executescript("""
+    db = get_db()
+    db.executescript("""
         CREATE TABLE IF NOT EXISTS halls(
             id TEXT PRIMARY KEY,
             title TEXT NOT NULL,
@@ -68,29 +113,44 @@ def init_db():
             addons TEXT,
             price INTEGER,
             status TEXT NOT NULL DEFAULT 'confirmed',
-            created_at TEXT NOT NULL
+            created_at TEXT NOT NULL,
+            ics TEXT
         );
-        """)
-        c = db.execute("SELECT COUNT(*) FROM halls").fetchone()[0]
-        if c == 0:
-            db.executemany(
-                "INSERT INTO halls (id,title,base_price,weekend_coef) VALUES (?,?,?,?)",
-                HALLS_SEED
-            )
-            db.commit()
+        -- покрывающие индексы: /slots и коллизии в /book — range scan,
+        -- /bookings?phone=… — index-only lookup
+        CREATE INDEX IF NOT EXISTS idx_bookings_hall_date_status
+            ON bookings(hall_id, date, status, start_min, end_min);
+        CREATE INDEX IF NOT EXISTS idx_bookings_phone_status
+            ON bookings(phone, status, date, start_min);
+    """)
+    # миграция для баз, созданных до появления колонки ics
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(bookings)")}
+    if "ics" not in cols:
+        db.execute("ALTER TABLE bookings ADD COLUMN ics TEXT")
+    c = db.execute("SELECT COUNT(*) FROM halls").fetchone()[0]
+    if c == 0:
+        db.executemany(
+            "INSERT INTO halls (id,title,base_price,weekend_coef) VALUES (?,?,?,?)",
+            HALLS_SEED
+        )
 
 def is_weekend(date_iso: str) -> bool:
-    y, m, d = map(int, date_iso.split("-"))
-    return datetime(y, m, d).isoweekday() in (6, 7)
+    return date.fromisoformat(date_iso).weekday() >= 5
 
-def calc_price(hall: sqlite3.Row, date_iso: str, start_min: int, addons: list[dict]) -> int:
-    price = int(hall["base_price"])
+@lru_cache(maxsize=4096)
+def _slot_price(base_price: int, weekend_coef: float, date_iso: str, start_min: int) -> int:
+    # цена слота без допов — детерминирована, кэшируем по (зал, дата, старт)
+    price = base_price
     if is_weekend(date_iso):
-        price = round(price * float(hall["weekend_coef"]))
+        price = round(price * weekend_coef)
     if 17 <= (start_min // 60) < 21:
         price = round(price * 1.3)  # прайм-тайм
-    for a in addons:
-        price += int(a.get("price", 0))
+    return price
+
+def calc_price(hall: dict, date_iso: str, start_min: int, addons: list[str]) -> int:
+    price = _slot_price(int(hall["base_price"]), float(hall["weekend_coef"]), date_iso, start_min)
+    for n in addons:
+        price += ADDONS_PRICE.get(n, 0)
     return price
 
 def time_to_min(hhmm: str) -> int:
@@ -103,50 +163,112 @@ def parse_slot(slot: str) -> int:
     start = s.split("-")[0].strip()
     return time_to_min(start)
 
+# --- Опциональный JIT для развёртки слотов ---
+# numba окупается только на больших списках занятости (пакетные выборки
+# за месяц): на типичных ≤12 интервалах диспатч в нативный код дороже
+# самого цикла, поэтому путь включается по порогу и только если numba
+# вообще установлена.
+_JIT_MIN_BUSY = 16
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+else:
+    @njit(cache=True)
+    def _free_slots_jit(busy_s, busy_e, work_start, work_end, slot_dur, buf):
+        n = busy_s.shape[0]
+        out = np.empty((work_end - work_start) // slot_dur, np.int32)
+        i = 0
+        k = 0
+        start = work_start
+        while start + slot_dur <= work_end:
+            while i < n and busy_e[i] + buf <= start:
+                i += 1
+            if not (i < n and start + slot_dur + buf > busy_s[i]):
+                out[k] = start
+                k += 1
+            start += slot_dur
+        return out[:k]
+
+    # прогрев при импорте, чтобы первый запрос не платил за компиляцию
+    _free_slots_jit(np.empty(0, np.int32), np.empty(0, np.int32),
+                    WORK_START, WORK_END, SLOT_DUR, BUFFER)
+
+# подписи часовых слотов фиксированы — считаем один раз при импорте
+_SLOT_LABEL = {
+    s: f"{s//60:02d}:{s%60:02d}–{(s+60)//60:02d}:{(s+60)%60:02d}"
+    for s in SLOT_STARTS
+}
+
 def min_to_range(start_min: int, dur: int = 60) -> str:
+    if dur == 60:
+        label = _SLOT_LABEL.get(start_min)
+        if label is not None:
+            return label
     end = start_min + dur
     h1, m1 = divmod(start_min, 60)
     h2, m2 = divmod(end, 60)
     return f"{h1:02d}:{m1:02d}–{h2:02d}:{m2:02d}"
 
+# шаблон события фиксирован — компилируем один раз, заполняем за один format
+_ICS_TEMPLATE = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "PRODID:-//StudioLumi//EN\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:{uid}\r\n"
+    "DTSTAMP:{dtstamp}\r\n"
+    "DTSTART:{y:04d}{m:02d}{d:02d}T{sh:02d}{sm:02d}00\r\n"
+    "DTEND:{y:04d}{m:02d}{d:02d}T{eh:02d}{em:02d}00\r\n"
+    "SUMMARY:Съёмка — Studio Lumi ({hall_id})\r\n"
+    "DESCRIPTION:Бронь {uid}\\nКлиент: {client}\r\n"
+    "LOCATION:Studio Lumi\r\n"
+    "END:VEVENT\r\n"
+    "END:VCALENDAR\r\n"
+)
+
 def make_ics(booking_id: str, hall_id: str, date: str, start_min: int, end_min: int, name: str|None, phone: str|None) -> str:
-    # простая генерация .ics без внешних библиотек
+    # простая генерация .ics без внешних библиотек; контент храним в БД,
+    # на диск не пишем
     y, m, d = map(int, date.split("-"))
     sh, sm = divmod(start_min, 60)
     eh, em = divmod(end_min, 60)
-
-    def z2(n): return f"{n:02d}"
-    dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    dtstart = f"{y}{z2(m)}{z2(d)}T{z2(sh)}{z2(sm)}00"
-    dtend   = f"{y}{z2(m)}{z2(d)}T{z2(eh)}{z2(em)}00"
-
-    content = (
-        "BEGIN:VCALENDAR\r\n"
-        "VERSION:2.0\r\n"
-        "PRODID:-//StudioLumi//EN\r\n"
-        "BEGIN:VEVENT\r\n"
-        f"UID:{booking_id}\r\n"
-        f"DTSTAMP:{dtstamp}\r\n"
-        f"DTSTART:{dtstart}\r\n"
-        f"DTEND:{dtend}\r\n"
-        f"SUMMARY:Съёмка — Studio Lumi ({hall_id})\r\n"
-        f"DESCRIPTION:Бронь {booking_id}\\nКлиент: {name or ''} {phone or ''}\r\n"
-        "LOCATION:Studio Lumi\r\n"
-        "END:VEVENT\r\n"
-        "END:VCALENDAR\r\n"
+    return _ICS_TEMPLATE.format(
+        uid=booking_id,
+        dtstamp=datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"),
+        y=y, m=m, d=d, sh=sh, sm=sm, eh=eh, em=em,
+        hall_id=hall_id,
+        client=f"{name or ''} {phone or ''}",
     )
 
-    rel = f"/ics/{booking_id}.ics"
-    path = os.path.join(ICS_DIR, f"{booking_id}.ics")
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
-    return rel
-
 def pretty_label(d: date) -> str:
     return f"{RU_WD[d.isoweekday()-1]}, {d.day} {RU_MM[d.month-1]}"
 # --- Инициализируем БД при импорте ---
 init_db()
 
+# залы — неизменяемые seed-данные, читаем из БД один раз при старте
+HALLS = {
+    r["id"]: dict(r)
+    for r in get_db().execute("SELECT id,base_price,weekend_coef FROM halls")
+}
+
+# --- Схемы запросов ---
+# типизированные модели: pydantic-core валидирует JSON в компилированном
+# коде и отбрасывает мусорные payload до какого-либо SQL
+class BookReq(BaseModel):
+    model_config = {"extra": "ignore"}
+    hall_id: str
+    date: str
+    slot: str
+    phone: str
+    name: str | None = None
+    addons: list[str] = []
+
+class CancelReq(BaseModel):
+    model_config = {"extra": "ignore"}
+    booking_id: str
+
 # --- Эндпоинты ---
 @app.post("/book_sp")
 def book_sp(payload: dict):
@@ -154,7 +276,11 @@ def book_sp(payload: dict):
     Специально для SendPulse: создаёт бронь и возвращает удобный JSON.
     """
     # вызываем существующую логику брони (эндпоинт /book использует эту же функцию под капотом)
-    result = book(payload)   # вернёт dict: booking_id, price, ics_url, status
+    try:
+        req = BookReq.model_validate(payload)
+    except ValidationError:
+        raise HTTPException(400, "hall_id, date, slot, phone required")
+    result = book(req)   # вернёт dict: booking_id, price, ics_url, status
 
     text = (
         f"✅ Бронь №{result['booking_id']}\n"
@@ -209,7 +335,11 @@ def debug_book(payload: dict):
 @app.post("/book_text")
 def book_text(payload: dict):
     # используем ту же логику бронирования и отдаём ПЛОСКИЙ ТЕКСТ (без JSON)
-    result = book(payload)  # вызываем наш существующий эндпоинт-функцию
+    try:
+        req = BookReq.model_validate(payload)
+    except ValidationError:
+        raise HTTPException(400, "hall_id, date, slot, phone required")
+    result = book(req)  # вызываем наш существующий эндпоинт-функцию
     return PlainTextResponse(
         f"Бронь №{result['booking_id']}\n"
         f"Дата: {payload.get('date')} {payload.get('slot')}\n"
@@ -221,98 +351,126 @@ def book_text(payload: dict):
 def slots(hall_id: str, date: str):
     if not hall_id or not date:
         raise HTTPException(400, "hall_id and date required")
-    with get_db() as db:
-        rows = db.execute(
-            "SELECT start_min,end_min FROM bookings WHERE hall_id=? AND date=? AND status='confirmed'",
-            (hall_id, date)
-        ).fetchall()
-    busy = [(r["start_min"], r["end_min"]) for r in rows]
+    rows = get_db().execute(
+        "SELECT start_min,end_min FROM bookings WHERE hall_id=? AND date=? AND status='confirmed'",
+        (hall_id, date)
+    ).fetchall()
+    # один проход слева направо вместо O(slots × busy):
+    # busy отсортирован по началу, курсор i двигается только вперёд
+    busy = sorted((r["start_min"], r["end_min"]) for r in rows)
+    if np is not None and len(busy) >= _JIT_MIN_BUSY:
+        busy_s = np.fromiter((s for s, _ in busy), np.int32, len(busy))
+        busy_e = np.fromiter((e for _, e in busy), np.int32, len(busy))
+        free = _free_slots_jit(busy_s, busy_e, WORK_START, WORK_END, SLOT_DUR, BUFFER)
+        out = [min_to_range(int(s), SLOT_DUR) for s in free]
+        return {"date": date, "hall_id": hall_id, "slots": out}
     out = []
-    start = WORK_START
-    while start + SLOT_DUR <= WORK_END:
-        end = start + SLOT_DUR
-        conflict = any(not (end + BUFFER <= s or start >= e + BUFFER) for s, e in busy)
-        if not conflict:
-            out.append(min_to_range(start, SLOT_DUR))
-        start += SLOT_DUR
+    i, n = 0, len(busy)
+    for start in SLOT_STARTS:
+        while i < n and busy[i][1] + BUFFER <= start:
+            i += 1
+        if i < n and start + SLOT_DUR + BUFFER > busy[i][0]:
+            continue  # пересекается с ближайшей занятой бронью
+        out.append(min_to_range(start, SLOT_DUR))
     return {"date": date, "hall_id": hall_id, "slots": out}
 
 @app.post("/book")
-def book(payload: dict):
-    hall_id = payload.get("hall_id")
-    date    = payload.get("date")
-    slot    = payload.get("slot")
-    name    = payload.get("name")
-    phone   = payload.get("phone")
-    addons_names = payload.get("addons", [])
+def book(payload: BookReq):
+    hall_id = payload.hall_id
+    date    = payload.date
+    slot    = payload.slot
+    name    = payload.name
+    phone   = payload.phone
+    addons_names = payload.addons
     if not (hall_id and date and slot and phone):
         raise HTTPException(400, "hall_id, date, slot, phone required")
 
     start_min = parse_slot(slot)
     end_min   = start_min + SLOT_DUR
 
-    with get_db() as db:
-        # проверка коллизий
-        row = db.execute(
+    hall = HALLS.get(hall_id)
+    if not hall:
+        raise HTTPException(400, "Unknown hall")
+
+    addons_json = "[" + ",".join(_ADDON_JSON[n] for n in addons_names if n in _ADDON_JSON) + "]"
+    price = calc_price(hall, date, start_min, addons_names)
+    booking_id = f"BK-{date}-{hall_id}-{start_min//60:02d}00"
+    ics = make_ics(booking_id, hall_id, date, start_min, end_min, name, phone)
+
+    # проверка коллизий и вставка одним атомарным стейтментом —
+    # между SELECT и INSERT никто не успеет занять слот
+    with _write_tx() as db:
+        cur = db.execute(
             """
-            SELECT 1 FROM bookings
-            WHERE hall_id=? AND date=? AND status='confirmed'
-              AND NOT (? + ? <= start_min OR ? >= end_min + ?)
-            LIMIT 1
+            INSERT INTO bookings (booking_id,hall_id,date,start_min,end_min,name,phone,addons,price,status,created_at,ics)
+            SELECT ?,?,?,?,?,?,?,?,?,'confirmed',datetime('now'),?
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bookings
+                WHERE hall_id=? AND date=? AND status='confirmed'
+                  AND NOT (? + ? <= start_min OR ? >= end_min + ?)
+            )
             """,
-            (hall_id, date, end_min, BUFFER, start_min, BUFFER)
-        ).fetchone()
-        if row:
-            raise HTTPException(409, "Slot not available")
-
-        hall = db.execute("SELECT * FROM halls WHERE id=?", (hall_id,)).fetchone()
-        if not hall:
-            raise HTTPException(400, "Unknown hall")
-
-        addons_d = [{"name": n, "price": ADDONS_PRICE.get(n, 0)} for n in addons_names]
-        price = calc_price(hall, date, start_min, addons_d)
-        booking_id = f"BK-{date}-{hall_id}-{start_min//60:02d}00"
-
-        db.execute(
-            "INSERT INTO bookings (booking_id,hall_id,date,start_min,end_min,name,phone,addons,price,status,created_at) "
-            "VALUES (?,?,?,?,?,?,?,?,?,'confirmed',datetime('now'))",
-            (booking_id, hall_id, date, start_min, end_min, name, phone, json.dumps(addons_d, ensure_ascii=False), price)
+            (booking_id, hall_id, date, start_min, end_min, name, phone,
+             addons_json, price, ics,
+             hall_id, date, end_min, BUFFER, start_min, BUFFER)
         )
-        db.commit()
+    if cur.rowcount == 0:
+        raise HTTPException(409, "Slot not available")
 
-    ics_url = f"{BASE_URL}{make_ics(booking_id, hall_id, date, start_min, end_min, name, phone)}"
+    ics_url = f"{BASE_URL}/ics/{booking_id}.ics"
     return {"booking_id": booking_id, "price": price, "status": "confirmed", "ics_url": ics_url}
 
 @app.post("/cancel")
-def cancel(payload: dict):
-    booking_id = payload.get("booking_id")
+def cancel(payload: CancelReq):
+    booking_id = payload.booking_id
     if not booking_id:
         raise HTTPException(400, "booking_id required")
-    with get_db() as db:
+    with _write_tx() as db:
         db.execute("UPDATE bookings SET status='canceled' WHERE booking_id=?", (booking_id,))
-        db.commit()
     return {"ok": True}
 
 @app.get("/bookings")
 def bookings(phone: str):
-    with get_db() as db:
-        rows = db.execute(
-            "SELECT booking_id,hall_id,date,start_min,price FROM bookings WHERE phone=? AND status='confirmed' ORDER BY date,start_min",
-            (phone,)
-        ).fetchall()
-    return [
-        {"booking_id": r["booking_id"], "hall_id": r["hall_id"], "date": r["date"], "slot": min_to_range(r["start_min"]), "price": r["price"]}
-        for r in rows
-    ]
+    # подпись слота собирает SQLite (printf), Python строк не форматирует;
+    # набор колонок уже совпадает со схемой ответа
+    rows = get_db().execute(
+        "SELECT booking_id,hall_id,date,"
+        "printf('%02d:%02d–%02d:%02d', start_min/60, start_min%60, (start_min+60)/60, (start_min+60)%60) AS slot,"
+        "price "
+        "FROM bookings WHERE phone=? AND status='confirmed' ORDER BY date,start_min",
+        (phone,)
+    ).fetchall()
+    return [dict(r) for r in rows]
 
 @app.get("/ics/{fname}")
-def ics_files(fname: str):
-    path = os.path.join(ICS_DIR, fname)
-    if not os.path.isfile(path):
+def ics_files(fname: str, request: Request):
+    booking_id = fname[:-4] if fname.endswith(".ics") else fname
+    # контент неизменяем для данного booking_id — сильный ETag,
+    # повторные загрузки календаря отдаём как пустой 304
+    etag = f'"{booking_id}"'
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    row = get_db().execute(
+        "SELECT ics FROM bookings WHERE booking_id=?", (booking_id,)
+    ).fetchone()
+    if not row or not row["ics"]:
         raise HTTPException(404, "not found")
-    return FileResponse(path, media_type="text/calendar")
+    return Response(
+        row["ics"], media_type="text/calendar",
+        headers={**cache_headers,
+                 "Content-Disposition": f'attachment; filename="{fname}"'}
+    )
 
-# Запуск: uvicorn app:app --host 0.0.0.0 --port 8000
+# Запуск (прод):
+#   uvicorn app:app --host 0.0.0.0 --port 8000 \
+#       --workers $(nproc) --loop uvloop --http httptools
+# uvloop/httptools ставятся вместе с uvicorn[standard]; несколько воркеров
+# безопасны: _CONN создаётся при импорте модуля, т.е. отдельно в каждом
+# процессе, а WAL-читатели разных воркеров друг друга не блокируют.
 
 
 